@@ -1,26 +1,79 @@
 import asyncio
+import html
 import os
-from datetime import datetime
+import secrets
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import groupby
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
+from apscheduler.events import EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import database
+from lanes import UserLanes
 
 main_menu = ReplyKeyboardMarkup(keyboard=[
     [KeyboardButton(text="🌟 Добавить задачу")],
     [KeyboardButton(text="📋 Мои задачи"), KeyboardButton(text="🏁 Выполненные")],
     [KeyboardButton(text="📈 Прогресс"), KeyboardButton(text="📁 Проекты")],
-    [KeyboardButton(text="🎯 За неделю")]
+    [KeyboardButton(text="🎯 За неделю"), KeyboardButton(text="🗓 План на неделю")]
 ], resize_keyboard=True)
 
 API_TOKEN = os.getenv("API_TOKEN")
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+ANALYTICS_REFRESH_MINUTES = int(os.getenv("ANALYTICS_REFRESH_MINUTES", "15"))
+REMINDER_CATCHUP_HOURS = int(os.getenv("REMINDER_CATCHUP_HOURS", "24"))
+# Общий срок на всю остановку; должен быть меньше grace period платформы (в Docker 10 с)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "8"))
+SHUTDOWN_CLOSE_RESERVE = 2  # из общего срока — на закрытие пула и сессии бота
+REMINDER_SEND_ATTEMPTS = 3
+OVERDUE_BUTTONS_PER_MESSAGE = 20
 bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
+lanes = UserLanes()
+dp.update.outer_middleware(lanes)
 scheduler = AsyncIOScheduler()
 
+MESSAGE_LIMIT = 4000  # Telegram режет сообщения длиннее 4096 символов
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+def split_long_line(line):
+    # Режем слишком длинную строку так, чтобы не разорвать HTML-тег или &сущность;
+    pieces = []
+    while len(line) > MESSAGE_LIMIT:
+        head = line[:MESSAGE_LIMIT]
+        cut = MESSAGE_LIMIT
+        if head.rfind("<") > head.rfind(">"):
+            cut = head.rfind("<")
+        elif head.rfind("&") > head.rfind(";"):
+            cut = head.rfind("&")
+        if cut <= 0:
+            # Открытый тег или сущность в самом начале — режем по последнему пробелу
+            cut = head.rfind(" ")
+        if cut <= 0:
+            cut = MESSAGE_LIMIT
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return pieces
+
+def split_message(lines):
+    # Собираем строки в сообщения, не превышающие лимит Telegram
+    chunks, current = [], ""
+    for line in lines:
+        for piece in split_long_line(line):
+            if current and len(current) + len(piece) > MESSAGE_LIMIT:
+                chunks.append(current)
+                current = ""
+            current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
 def get_task_buttons(task_id):
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Сделано", callback_data=f"done:{task_id}")
@@ -85,12 +138,53 @@ async def show_today_tasks(message: Message):
     if not tasks:
         await message.answer("Сегодня всё свободно. Можно отдохнуть или сделать что-то по душе 🌼")
         return
-    text = "<b>Твои задачи на сегодня:</b>\n\n"
-    for title, task_time in tasks:
-        if isinstance(task_time, str):
-            task_time = datetime.strptime(task_time, "%H:%M").time()
-        text += f"🕒 <b>{task_time.strftime('%H:%M')}</b> — {title}\n"
-    await message.answer(text)
+    lines = ["<b>Твои задачи на сегодня:</b>\n\n"]
+    for _, task_time, title in tasks:
+        lines.append(f"🕒 <b>{task_time.strftime('%H:%M')}</b> — {html.escape(title)}\n")
+    for chunk in split_message(lines):
+        await message.answer(chunk)
+
+# 🗓 План на несколько дней
+AGENDA_DAYS = 7
+AGENDA_MAX_DAYS = 62
+
+@dp.message(F.text == "🗓 План на неделю")
+@dp.message(F.text.regexp(r"^/agenda( \d{2}\.\d{2})?( \d{2}\.\d{2})?$"))
+async def show_agenda(message: Message):
+    today = datetime.now().date()
+    args = message.text.split()[1:] if message.text.startswith("/agenda") else []
+    try:
+        start = datetime.strptime(f"{args[0]}.{today.year}", "%d.%m.%Y").date() if args else today
+        if start < today:
+            # В конце декабря /agenda 05.01 — это уже следующий год
+            start = datetime.strptime(f"{args[0]}.{today.year + 1}", "%d.%m.%Y").date()
+        end = start + timedelta(days=AGENDA_DAYS - 1)
+        if len(args) > 1:
+            end = datetime.strptime(f"{args[1]}.{start.year}", "%d.%m.%Y").date()
+            if end < start:
+                # /agenda 28.12 05.01 — конец периода уже в следующем году
+                end = datetime.strptime(f"{args[1]}.{start.year + 1}", "%d.%m.%Y").date()
+    except ValueError:
+        await message.answer("Формат: <code>/agenda</code> или <code>/agenda ДД.ММ ДД.ММ</code>")
+        return
+
+    if (end - start).days >= AGENDA_MAX_DAYS:
+        await message.answer(f"Период должен быть не длиннее {AGENDA_MAX_DAYS} дней 🙃")
+        return
+
+    tasks = await database.get_tasks_in_range(message.from_user.id, start, end)
+    if not tasks:
+        await message.answer(f"С {start.strftime('%d.%m')} по {end.strftime('%d.%m')} задач нет 🌼")
+        return
+
+    lines = [f"<b>🗓 План на {start.strftime('%d.%m')} — {end.strftime('%d.%m')}:</b>\n"]
+    # Задачи уже отсортированы по дате, поэтому группируем за один проход
+    for task_date, day_tasks in groupby(tasks, key=lambda task: task["date"]):
+        lines.append(f"\n<b>{WEEKDAYS[task_date.weekday()]}, {task_date.strftime('%d.%m')}</b>\n")
+        for _, task_time, title in day_tasks:
+            lines.append(f"🕒 {task_time.strftime('%H:%M')} — {html.escape(title)}\n")
+    for chunk in split_message(lines):
+        await message.answer(chunk)
 
 @dp.message(F.text == "🏁 Выполненные")
 async def show_done(message: Message):
@@ -271,6 +365,9 @@ async def help_command(message: Message):
 📋 <b>Мои задачи</b>
 Список задач на сегодня
 
+🗓 <b>План на неделю</b>
+Задачи на 7 дней вперёд, или за период: /agenda ДД.ММ ДД.ММ
+
 🏁 <b>Выполненные</b>
 Список завершённых задач
 
@@ -280,13 +377,239 @@ async def help_command(message: Message):
 📁 <b>Проекты</b>
 Управление проектами и группами задач
 
+🔎 <b>/find слова</b>
+Поиск по задачам и проектам
+
 Например: Убраться / 21:00 / 18.07 / #дом
 """)
 
+# 🔎 Поиск по задачам и проектам
+FIND_PAGE_SIZE = 10
+FIND_MAX_SEARCHES = 1000
+# Короткий случайный id поиска -> (user_id, запрос). В callback_data влезает только id;
+# случайный, а не счётчик, чтобы после рестарта старая кнопка не открыла чужой новый поиск
+_searches = OrderedDict()
+
+async def send_search_page(message: Message, user_id: int, search_id: str, page: int):
+    search = _searches.get(search_id)
+    if not search or search[0] != user_id:
+        await message.answer("Этот поиск устарел, повтори: <code>/find слова</code>")
+        return
+    text = search[1]
+    rows = await database.search_tasks(user_id, text, limit=FIND_PAGE_SIZE + 1, offset=page * FIND_PAGE_SIZE)
+    if not rows:
+        await message.answer("Ничего не нашлось 🌫")
+        return
+
+    answer = f"<b>🔎 Найдено по запросу «{html.escape(text[:100])}»:</b>\n\n"
+    for kind, title, task_date, task_time, completed, _ in rows[:FIND_PAGE_SIZE]:
+        if kind == "project":
+            answer += f"📁 {html.escape(title)}\n"
+        else:
+            status = "✅" if completed else "🔲"
+            answer += f"{status} {html.escape(title)} — {task_date.strftime('%d.%m')} {task_time.strftime('%H:%M')}\n"
+
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.button(text="⬅️ Назад", callback_data=f"find:{search_id}:{page - 1}")
+    if len(rows) > FIND_PAGE_SIZE:
+        builder.button(text="Дальше ➡️", callback_data=f"find:{search_id}:{page + 1}")
+    has_pages = page > 0 or len(rows) > FIND_PAGE_SIZE
+    await message.answer(answer, reply_markup=builder.as_markup() if has_pages else None)
+
+@dp.message(F.text.regexp(r"^/find(\s|$)"))
+async def find_command(message: Message):
+    text = message.text[len("/find"):].strip()
+    if not text:
+        await message.answer("Напиши, что искать: <code>/find слова</code>")
+        return
+    search_id = secrets.token_urlsafe(6)
+    _searches[search_id] = (message.from_user.id, text)
+    if len(_searches) > FIND_MAX_SEARCHES:
+        _searches.popitem(last=False)
+    await send_search_page(message, message.from_user.id, search_id, 0)
+
+@dp.callback_query(F.data.startswith("find:"))
+async def find_page(callback: CallbackQuery):
+    _, search_id, page = callback.data.split(":")
+    await send_search_page(callback.message, callback.from_user.id, search_id, int(page))
+    await callback.answer()
+
+# 🐢 Самые медленные запросы (только для админов)
+@dp.message(F.text.regexp(r"^/slow_queries(\s+\d+)?$"))
+async def slow_queries_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    parts = message.text.split()
+    limit = int(parts[1]) if len(parts) > 1 else 10
+    queries = database.get_slow_queries(limit)
+    if not queries:
+        await message.answer("Статистики по запросам пока нет.")
+        return
+    lines = ["<b>🐢 Запросы по суммарному времени:</b>\n\n"]
+    for sql, calls, total_ms, max_ms in queries:
+        lines.append(f"<b>{total_ms:.0f} мс</b> всего, {calls} вызовов, макс {max_ms:.0f} мс\n<code>{html.escape(sql[:300])}</code>\n\n")
+    for chunk in split_message(lines):
+        await message.answer(chunk)
+
+# 🛣 Загрузка дорожек обработки апдейтов (только для админов)
+@dp.message(F.text == "/lanes")
+async def lanes_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    stats = lanes.stats()
+    await message.answer(f"""
+<b>🛣 Дорожки обработки</b>
+
+Дорожек: <b>{stats["lanes"]}</b> (перегруз от {stats["lane_size"]} в очереди)
+Заняты сейчас: <b>{stats["busy"]}</b>
+В очередях: <b>{stats["queued"]}</b>, максимум на дорожке: <b>{stats["max_depth"]}</b>
+Переполнено дорожек: <b>{stats["saturated"]}</b>
+Обработано апдейтов: <b>{stats["processed"]}</b>
+""")
+
+# 📊 Общая статистика (только для админов)
+@dp.message(F.text == "/admin_stats")
+async def admin_stats_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    stats = await database.get_admin_stats()
+    projects = stats["projects"]
+
+    text = "<b>📊 Статистика за 7 дней</b>\n\n"
+    if not stats["daily"]:
+        text += "Активности пока нет.\n"
+    for day, active_users, tasks_created, done, missed in stats["daily"]:
+        total = done + missed
+        percent = int((done / total) * 100) if total else 0
+        text += f"<b>{day.strftime('%d.%m')}</b>: 👥 {active_users} · 📝 {tasks_created} · ✅ {done} · ❌ {missed} · {percent}%\n"
+
+    avg = projects["projects"] / projects["users"] if projects["users"] else 0
+    text += f"\n📁 Проекты: <b>{projects['projects']}</b> у {projects['users']} пользователей, "
+    text += f"в среднем {avg:.1f}, максимум {projects['max_projects']}\n"
+
+    text += "\n<b>Обновлено:</b>\n"
+    for view in database.ANALYTICS_VIEWS:
+        refreshed_at = stats["refreshed"].get(view)
+        text += f"{view}: {refreshed_at.strftime('%d.%m %H:%M') if refreshed_at else 'ещё не обновлялась'}\n"
+    await message.answer(text)
+
+REMINDER_JOB_ID = "reminders"
+# Будущее «рассылка завершилась» -> её asyncio-задача (None, пока задача не стартовала)
+_reminder_runs = {}
+_submitted_reminder_run = None
+_stopping = False
+# Ошибки самого чата: повторять бессмысленно. Прочие BadRequest — наши баги форматирования
+PERMANENT_CHAT_ERRORS = ("chat not found", "user not found", "peer_id_invalid")
+
+def track_reminder_submission(event):
+    # Учитываем рассылку в момент постановки APScheduler'ом, а не на её первой строке:
+    # иначе остановка не дождалась бы уже созданной, но ещё не начавшейся задачи
+    global _submitted_reminder_run
+    if event.job_id == REMINDER_JOB_ID:
+        _submitted_reminder_run = asyncio.get_running_loop().create_future()
+        _reminder_runs[_submitted_reminder_run] = None
+
+def escape_limited(text, limit):
+    # Сначала экранируем, потом режем — и не посреди &сущности;
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    cut = escaped[:limit - 1]
+    if cut.rfind("&") > cut.rfind(";"):
+        cut = cut[:cut.rfind("&")]
+    return cut + "…"
+
+async def deliver_reminder(user_id, text, reply_markup):
+    # True — доставлено или доставить невозможно в принципе (бот заблокирован, чата нет),
+    # False — не доставлено, напоминание остаётся в окне следующего тика
+    for attempt in range(REMINDER_SEND_ATTEMPTS):
+        try:
+            await bot.send_message(user_id, text, reply_markup=reply_markup)
+            return True
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError as e:
+            print(f"⛔ Напоминание {user_id} не доставить: {e}")
+            return True
+        except TelegramBadRequest as e:
+            if any(marker in e.message.lower() for marker in PERMANENT_CHAT_ERRORS):
+                print(f"⛔ Напоминание {user_id} не доставить: {e}")
+                return True
+            print(f"❌ Telegram отклонил напоминание {user_id}: {e}")
+            return False
+        except Exception as e:
+            print(f"❌ Не удалось отправить напоминание {user_id} (попытка {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    return False
+
+def overdue_batches(tasks):
+    # Делим просроченные задачи на сообщения в пределах лимита текста и кнопок
+    batch, text = [], "⏳ Пока меня не было, подошло время для:\n\n"
+    for task in tasks:
+        line = f"🕒 {task['due'].strftime('%d.%m %H:%M')} — {escape_limited(task['title'], 300)}\n"
+        if batch and (len(text) + len(line) > MESSAGE_LIMIT or len(batch) >= OVERDUE_BUTTONS_PER_MESSAGE):
+            yield text, batch
+            batch, text = [], ""
+        batch.append(task)
+        text += line
+    if batch:
+        yield text, batch
+
+async def send_overdue_reminders(user_id, tasks):
+    failed = []
+    for text, batch in overdue_batches(tasks):
+        builder = InlineKeyboardBuilder()
+        for task in batch:
+            builder.button(text=f"✅ {task['title'][:30]}", callback_data=f"done:{task['id']}")
+        builder.adjust(1)
+        if await deliver_reminder(user_id, text, builder.as_markup()):
+            await database.mark_tasks_reminded([task["id"] for task in batch], datetime.now())
+        else:
+            failed += batch
+    return failed
+
 async def send_reminders():
-    tasks = await database.get_tasks_for_now()
-    for user_id, task_id, title in tasks:
-        await bot.send_message(user_id, f"🌸 Напоминание: {title}", reply_markup=get_task_buttons(task_id))
+    global _submitted_reminder_run
+    done, _submitted_reminder_run = _submitted_reminder_run, None
+    if done is None:
+        done = asyncio.get_running_loop().create_future()
+    _reminder_runs[done] = asyncio.current_task()
+    try:
+        if _stopping:
+            return
+        # Рассылаем всё, что стало «пора» после последней обработанной минуты,
+        # поэтому пропущенные из-за рестарта или медленного тика минуты не теряются
+        now = datetime.now().replace(second=0, microsecond=0)
+        since = await database.get_reminders_processed_until() or now - timedelta(minutes=1)
+        since = max(since, now - timedelta(hours=REMINDER_CATCHUP_HOURS))
+        if since >= now:
+            return
+
+        tasks = await database.get_tasks_due(since, now)
+        failed = []
+        for user_id, user_tasks in groupby(tasks, key=lambda task: task["user_id"]):
+            user_tasks = list(user_tasks)
+            overdue = [task for task in user_tasks if task["due"] < now]
+            if overdue:
+                failed += await send_overdue_reminders(user_id, overdue)
+            for task in user_tasks:
+                if task["due"] == now:
+                    text = f"🌸 Напоминание: {escape_limited(task['title'], MESSAGE_LIMIT - 20)}"
+                    if await deliver_reminder(user_id, text, get_task_buttons(task["id"])):
+                        await database.mark_tasks_reminded([task["id"]], datetime.now())
+                    else:
+                        failed.append(task)
+
+        # Неотправленное из-за временных ошибок остаётся в окне следующего тика;
+        # уже отправленное не повторится благодаря reminded_at
+        processed_until = now
+        if failed:
+            processed_until = min(task["due"] for task in failed) - timedelta(microseconds=1)
+        await database.set_reminders_processed_until(processed_until)
+    finally:
+        del _reminder_runs[done]
+        done.set_result(None)
 
 async def notify_all_users():
     users = await database.get_all_user_ids()
@@ -307,14 +630,57 @@ async def notify_all_users():
 async def main():
     await database.init()
 
-    scheduler.add_job(send_reminders, "interval", minutes=1)
+    # Первый тик сразу: догоняем напоминания, пропущенные пока бот был выключен
+    scheduler.add_listener(track_reminder_submission, EVENT_JOB_SUBMITTED)
+    scheduler.add_job(send_reminders, "interval", minutes=1, next_run_time=datetime.now(), id=REMINDER_JOB_ID)
+    scheduler.add_job(database.refresh_analytics, "interval", minutes=ANALYTICS_REFRESH_MINUTES, next_run_time=datetime.now())
     scheduler.start()
 
     # Отложить уведомление на 30 секунд
-    asyncio.create_task(delayed_notify())
+    notify_task = asyncio.create_task(delayed_notify())
 
     print("✨ Бот запущен!")
-    await dp.start_polling(bot)
+    try:
+        # aiogram сам ловит SIGTERM/SIGINT и останавливает polling
+        # Лимит задач даёт backpressure: при всплеске polling ждёт, а не копит апдейты в памяти
+        await dp.start_polling(bot, close_bot_session=False, tasks_concurrency_limit=lanes.max_in_flight)
+    finally:
+        notify_task.cancel()
+        await shutdown()
+
+# 🛑 Аккуратная остановка
+async def shutdown():
+    global _stopping
+    print("🛑 Останавливаемся...")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_TIMEOUT
+
+    def remaining():
+        return max(0, deadline - loop.time())
+
+    # Новых тиков больше не будет; поставленная, но не начавшаяся рассылка сразу выйдет
+    _stopping = True
+    scheduler.pause()
+
+    async def drain_reminders(timeout):
+        if not _reminder_runs:
+            return
+        _, pending = await asyncio.wait(set(_reminder_runs), timeout=timeout)
+        for done in pending:
+            print("⚠️ Рассылка напоминаний не успела завершиться, прерываем")
+            task = _reminder_runs.get(done)
+            if task is not None:
+                task.cancel()
+
+    # Напоминания и апдейты пользователей дорабатывают параллельно, у каждого свой
+    # полный срок; запас в конце остаётся на закрытие пула и сессии
+    drain_timeout = max(0, SHUTDOWN_TIMEOUT - SHUTDOWN_CLOSE_RESERVE)
+    await asyncio.gather(drain_reminders(drain_timeout), lanes.close(drain_timeout))
+    scheduler.shutdown(wait=False)
+
+    await database.close(remaining())
+    await bot.session.close()
+    print("👋 Бот остановлен")
 
 async def delayed_notify():
     await asyncio.sleep(30)
@@ -1,33 +1,252 @@
 import asyncpg
+import asyncio
 from datetime import datetime, date, timedelta
 import os
+import random
+import re
 import ssl
+import time
 
 _pool = None
+_replica_pool = None
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("❌ DATABASE_URL не установлен!")
 
+# 📚 Реплика для чтения (по желанию)
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv("REPLICA_LAG_CHECK_SECONDS", "5"))
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "30"))
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+# Только для тестов на двух независимых инстансах: разрешить «реплику» не в режиме recovery
+REPLICA_ALLOW_PRIMARY = os.getenv("REPLICA_ALLOW_PRIMARY") == "1"
+
+REPLICA_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError,
+                  asyncpg.InterfaceError, asyncpg.CannotConnectNowError)
+# Hot standby отменяет запросы при конфликте с recovery — реплика жива, просто повторяем на primary
+REPLICA_CONFLICTS = (asyncpg.SerializationError, asyncpg.QueryCanceledError)
+
+_replica_pool_lock = asyncio.Lock()
+_replica_down_until = 0.0
+_replica_lag_checked_at = 0.0
+_replica_lagging = False
+_last_write = {}  # user_id -> time.monotonic() последней записи
+
+# 🐢 Трассировка медленных запросов
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+EXPLAIN_SAMPLE_RATE = float(os.getenv("EXPLAIN_SAMPLE_RATE", "0.1"))
+EXPLAIN_LOG_FILE = os.getenv("EXPLAIN_LOG_FILE", "slow_queries.log")
+
+# SQL (без лишних пробелов) -> {"calls", "total_ms", "max_ms"}
+_query_stats = {}
+_explain_tasks = set()
+
+
+def _normalize_sql(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def _param_shapes(args) -> str:
+    # Логируем только типы параметров, а не сами значения пользователей
+    return "(" + ", ".join(type(a).__name__ for a in args or ()) + ")"
+
+
+def _log_query(record, replica: bool = False):
+    sql = _normalize_sql(record.query)
+    if sql.upper().startswith("EXPLAIN"):
+        return
+    elapsed_ms = record.elapsed * 1000
+
+    stats = _query_stats.setdefault(sql, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["calls"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+    if elapsed_ms < SLOW_QUERY_MS:
+        return
+    print(f"🐢 Медленный запрос {elapsed_ms:.1f} мс {_param_shapes(record.args)}: {sql}")
+
+    # EXPLAIN ANALYZE выполняет запрос, поэтому повторяем только SELECT.
+    # Не больше одного снятия за раз, чтобы в разгар тормозов не занимать пул
+    if sql.upper().startswith("SELECT") and not _explain_tasks and random.random() < EXPLAIN_SAMPLE_RATE:
+        task = asyncio.get_running_loop().create_task(_capture_explain(sql, record.args, elapsed_ms, replica))
+        _explain_tasks.add(task)
+        task.add_done_callback(_explain_tasks.discard)
+
+
+async def _capture_explain(sql: str, args, elapsed_ms: float, replica: bool):
+    try:
+        # План снимаем на том же сервере, где запрос был медленным
+        pool = _replica_pool if replica else await connect()
+        if pool is None:
+            return
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Обобщённый план показывает $1, $2 вместо значений пользователей
+                await conn.execute("SET LOCAL plan_cache_mode = force_generic_plan")
+                rows = await conn.fetch(f"EXPLAIN (ANALYZE, BUFFERS) {sql}", *(args or ()))
+        plan = "\n".join(row[0] for row in rows)
+        with open(EXPLAIN_LOG_FILE, "a", encoding="utf-8") as f:
+            f.write(f"-- {datetime.now().isoformat()} | {elapsed_ms:.1f} мс | {sql}\n{plan}\n\n")
+    except Exception as e:
+        print("Не удалось снять EXPLAIN:", e)
+
+
+async def _init_connection(conn):
+    conn.add_query_logger(_log_query)
+
+
+async def _init_replica_connection(conn):
+    conn.add_query_logger(lambda record: _log_query(record, replica=True))
+
+
+# Топ запросов по суммарному времени выполнения
+def get_slow_queries(limit: int = 10):
+    top = sorted(_query_stats.items(), key=lambda item: item[1]["total_ms"], reverse=True)
+    return [(sql, stats["calls"], stats["total_ms"], stats["max_ms"]) for sql, stats in top[:limit]]
+
+def _ssl_context():
+    # Создаем SSL контекст для Railway/Render
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
 async def connect():
     global _pool
     if _pool is None:
-        # Создаем SSL контекст для Railway/Render
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        
+        ssl_context = _ssl_context()
+
         _pool = await asyncpg.create_pool(
             DATABASE_URL,
             ssl=ssl_context,  # Изменено с ssl=False на ssl=ssl_context
             timeout=60,
             command_timeout=60,
             min_size=1,
-            max_size=10
+            max_size=10,
+            init=_init_connection
         )
     return _pool
 
 
+def _mark_write(user_id: int):
+    # После своей записи пользователь какое-то время читает с primary
+    now = time.monotonic()
+    _last_write[user_id] = now
+    if len(_last_write) > 10000:
+        for uid, ts in list(_last_write.items()):
+            if now - ts > READ_YOUR_WRITES_SECONDS:
+                del _last_write[uid]
+
+
+def _replica_failed(e):
+    global _replica_down_until
+    print(f"⚠️ Реплика недоступна, читаем с primary: {e}")
+    _replica_down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+
+
+async def _check_replica_lag(pool):
+    global _replica_lag_checked_at, _replica_lagging
+    _replica_lag_checked_at = time.monotonic()
+    async with pool.acquire() as conn:
+        # Если всё полученное уже применено, реплика не отстаёт, даже если давно не было записей —
+        # но только пока WAL receiver подключён: без него receive_lsn замирает и replay его догоняет.
+        # status виден лишь с pg_read_all_stats, поэтому без прав достаточно живого pid.
+        # Сервер не в recovery (промоутнут или отделён после failover) мог разойтись с primary
+        row = await conn.fetchrow("""
+            SELECT pg_is_in_recovery() AS is_replica,
+                   EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+                           WHERE pid IS NOT NULL AND (status IS NULL OR status = 'streaming')) AS streaming,
+                   CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag
+        """)
+    if not row["is_replica"]:
+        lagging, reason = not REPLICA_ALLOW_PRIMARY, "не в режиме recovery (промоутнута?)"
+    elif not row["streaming"]:
+        lagging, reason = True, "WAL receiver не подключён"
+    else:
+        lag = row["lag"] or 0
+        lagging, reason = lag > REPLICA_MAX_LAG_SECONDS, f"отстаёт на {lag:.1f} с"
+    if lagging and not _replica_lagging:
+        print(f"⚠️ Реплика {reason}, читаем с primary")
+    _replica_lagging = lagging
+
+
+async def connect_replica():
+    # Под замком: параллельные чтения на старте не должны создать несколько пулов
+    global _replica_pool
+    if _replica_pool is not None:
+        return _replica_pool
+    async with _replica_pool_lock:
+        if _replica_pool is None:
+            _replica_pool = await asyncpg.create_pool(
+                DATABASE_REPLICA_URL,
+                ssl=_ssl_context(),
+                timeout=5,
+                command_timeout=60,
+                min_size=1,
+                max_size=10,
+                init=_init_replica_connection
+            )
+    return _replica_pool
+
+
+async def connect_read(user_id: int = None):
+    # Пул для чтения, которое терпит небольшое отставание: реплика, если она
+    # настроена, жива и не отстаёт, и пользователь недавно ничего не записывал
+    if not DATABASE_REPLICA_URL or time.monotonic() < _replica_down_until:
+        return await connect()
+    if user_id is not None and time.monotonic() - _last_write.get(user_id, 0) < READ_YOUR_WRITES_SECONDS:
+        return await connect()
+
+    try:
+        pool = await connect_replica()
+        if time.monotonic() - _replica_lag_checked_at > REPLICA_LAG_CHECK_SECONDS:
+            await _check_replica_lag(pool)
+    except REPLICA_ERRORS as e:
+        _replica_failed(e)
+        return await connect()
+    return await connect() if _replica_lagging else pool
+
+
+async def _read(user_id, query):
+    # query(conn) выполняется на реплике, а если она упала посреди запроса — на primary
+    pool = await connect_read(user_id)
+    if pool is _replica_pool:
+        try:
+            async with pool.acquire() as conn:
+                return await query(conn)
+        except REPLICA_ERRORS as e:
+            _replica_failed(e)
+        except REPLICA_CONFLICTS as e:
+            print(f"⚠️ Запрос на реплике отменён, повторяем на primary: {e}")
+        pool = await connect()
+    async with pool.acquire() as conn:
+        return await query(conn)
+
+
+async def _close_pool(pool, timeout: float):
+    try:
+        await asyncio.wait_for(pool.close(), timeout)
+    except asyncio.TimeoutError:
+        print("⚠️ Пул не закрылся вовремя, обрываем соединения")
+        pool.terminate()
+
+
+async def close(timeout: float = 10):
+    # Один общий срок на оба пула, а не по timeout на каждый
+    global _pool, _replica_pool
+    deadline = time.monotonic() + timeout
+    if _replica_pool is not None:
+        await _close_pool(_replica_pool, max(0, deadline - time.monotonic()))
+        _replica_pool = None
+    if _pool is not None:
+        await _close_pool(_pool, max(0, deadline - time.monotonic()))
+        _pool = None
+
+
 async def init():
     pool = await connect()
     async with pool.acquire() as conn:
@@ -44,7 +263,8 @@ async def init():
                 completed INTEGER DEFAULT 0,
                 completed_at TIMESTAMP,
                 missed INTEGER DEFAULT 0,
-                project_id INTEGER
+                project_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
             CREATE TABLE IF NOT EXISTS task_logs (
                 id SERIAL PRIMARY KEY,
@@ -58,12 +278,90 @@ async def init():
                 user_id BIGINT,
                 title TEXT
             );
+
+            -- 🔎 Полнотекстовый поиск по названиям
+            ALTER TABLE tasks ADD COLUMN IF NOT EXISTS title_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('russian', coalesce(title, ''))) STORED;
+            ALTER TABLE projects ADD COLUMN IF NOT EXISTS title_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('russian', coalesce(title, ''))) STORED;
+            CREATE INDEX IF NOT EXISTS idx_tasks_title_tsv ON tasks USING GIN (title_tsv);
+            CREATE INDEX IF NOT EXISTS idx_projects_title_tsv ON projects USING GIN (title_tsv);
+            CREATE INDEX IF NOT EXISTS idx_tasks_user_date_time ON tasks (user_id, date, time);
+            DROP INDEX IF EXISTS idx_tasks_user_id;  -- покрыт составным индексом выше
+            CREATE INDEX IF NOT EXISTS idx_projects_user_id ON projects (user_id);
+
+            -- 📊 Аналитика для админов. У старых задач created_at остаётся пустым
+            ALTER TABLE tasks ADD COLUMN IF NOT EXISTS created_at TIMESTAMP;
+            ALTER TABLE tasks ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP;
+
+            -- Активные за день — и те, кто отмечал задачи, и те, кто их создавал.
+            -- Старая daily_stats считала только первых, поэтому вьюха переименована
+            DROP MATERIALIZED VIEW IF EXISTS daily_stats;
+            CREATE MATERIALIZED VIEW IF NOT EXISTS daily_activity AS
+                WITH activity AS (
+                    SELECT DATE(timestamp) AS day, user_id FROM task_logs WHERE timestamp IS NOT NULL
+                    UNION
+                    SELECT DATE(created_at) AS day, user_id FROM tasks WHERE created_at IS NOT NULL
+                ), active AS (
+                    SELECT day, COUNT(*) AS active_users
+                    FROM activity
+                    GROUP BY day
+                ), logs AS (
+                    SELECT DATE(timestamp) AS day,
+                           COUNT(*) FILTER (WHERE action = 'done') AS done,
+                           COUNT(*) FILTER (WHERE action = 'missed') AS missed
+                    FROM task_logs
+                    WHERE timestamp IS NOT NULL
+                    GROUP BY DATE(timestamp)
+                ), created AS (
+                    SELECT DATE(created_at) AS day, COUNT(*) AS tasks_created
+                    FROM tasks
+                    WHERE created_at IS NOT NULL
+                    GROUP BY DATE(created_at)
+                )
+                SELECT active.day,
+                       active.active_users,
+                       COALESCE(created.tasks_created, 0) AS tasks_created,
+                       COALESCE(logs.done, 0) AS done,
+                       COALESCE(logs.missed, 0) AS missed
+                FROM active
+                LEFT JOIN logs ON logs.day = active.day
+                LEFT JOIN created ON created.day = active.day;
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_daily_activity_day ON daily_activity (day);
+
+            CREATE MATERIALIZED VIEW IF NOT EXISTS user_project_stats AS
+                SELECT user_id, COUNT(*) AS projects
+                FROM projects
+                GROUP BY user_id;
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_user_project_stats_user ON user_project_stats (user_id);
+
+            CREATE TABLE IF NOT EXISTS stats_refreshes (
+                view_name TEXT PRIMARY KEY,
+                refreshed_at TIMESTAMP
+            );
+            DELETE FROM stats_refreshes WHERE view_name = 'daily_stats';
+
+            -- ⏰ Напоминания: до какого момента всё уже разослано
+            CREATE TABLE IF NOT EXISTS reminder_state (
+                id INTEGER PRIMARY KEY,
+                processed_until TIMESTAMP
+            );
+            -- Когда о задаче последний раз напомнили: повторная рассылка окна её не дублирует
+            ALTER TABLE tasks ADD COLUMN IF NOT EXISTS reminded_at TIMESTAMP;
+            CREATE INDEX IF NOT EXISTS idx_tasks_due ON tasks (date, time) WHERE completed = 0 AND missed = 0;
         """)
 
+    if DATABASE_REPLICA_URL:
+        try:
+            await connect_replica()
+        except REPLICA_ERRORS as e:
+            _replica_failed(e)
+
 async def create_user(user_id: int):
     pool = await connect()
     async with pool.acquire() as conn:
         await conn.execute("INSERT INTO users (user_id) VALUES ($1) ON CONFLICT DO NOTHING", user_id)
+    _mark_write(user_id)
 
 async def add_task(user_id: int, title: str, time: object, task_date: date, project_id: int = None):
     pool = await connect()
@@ -72,30 +370,57 @@ async def add_task(user_id: int, title: str, time: object, task_date: date, proj
             INSERT INTO tasks (user_id, title, time, date, project_id)
             VALUES ($1, $2, $3, $4, $5)
         """, user_id, title, time, task_date, project_id)
+    _mark_write(user_id)
 
 
-async def get_tasks_for_now():
-    now = datetime.now()
-    current_time = now.strftime("%H:%M")  # 🔧 Преобразуем во ВРЕМЯ в строковом виде
-    current_date = now.strftime("%Y-%m-%d")  # 🔧 Преобразуем дату в строку
+async def get_tasks_due(since: datetime, until: datetime):
+    # Задачи со временем в полуинтервале (since, until], сгруппированные по пользователю.
+    # Только с primary: отставшая реплика не увидела бы свежую задачу, а отметка
+    # processed_until всё равно ушла бы вперёд, и напоминание потерялось бы
     pool = await connect()
     async with pool.acquire() as conn:
         return await conn.fetch("""
-            SELECT user_id, id, title FROM tasks
-            WHERE to_char(time::time, 'HH24:MI') = $1 AND to_char(date::date, 'YYYY-MM-DD') = $2
+            SELECT user_id, id, title, date + time AS due FROM tasks
+            WHERE date BETWEEN $3 AND $4 AND date + time > $1 AND date + time <= $2
                   AND completed = 0 AND missed = 0
-        """, current_time, current_date)
+                  AND (reminded_at IS NULL OR reminded_at < date + time)
+            ORDER BY user_id, date, time
+        """, since, until, since.date(), until.date())
 
 
-async def get_tasks_for_user_today(user_id: int):
-    today = date.today().strftime("%Y-%m-%d")  # 🔧 Преобразуем дату в строку
+async def mark_tasks_reminded(task_ids: list, moment: datetime):
     pool = await connect()
     async with pool.acquire() as conn:
-        return await conn.fetch("""
-            SELECT title, time FROM tasks
-            WHERE user_id = $1 AND date::text = $2 AND completed = 0 AND missed = 0
-            ORDER BY time ASC
-        """, user_id, today)
+        await conn.execute("UPDATE tasks SET reminded_at = $2 WHERE id = ANY($1::int[])", task_ids, moment)
+
+
+async def get_reminders_processed_until():
+    pool = await connect()
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT processed_until FROM reminder_state WHERE id = 1")
+
+
+async def set_reminders_processed_until(moment: datetime):
+    pool = await connect()
+    async with pool.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO reminder_state (id, processed_until) VALUES (1, $1)
+            ON CONFLICT (id) DO UPDATE SET processed_until = EXCLUDED.processed_until
+        """, moment)
+
+
+async def get_tasks_in_range(user_id: int, start: date, end: date):
+    # Идёт по индексу (user_id, date, time) и сразу отдаёт задачи в нужном порядке
+    return await _read(user_id, lambda conn: conn.fetch("""
+        SELECT date, time, title FROM tasks
+        WHERE user_id = $1 AND date BETWEEN $2 AND $3 AND completed = 0 AND missed = 0
+        ORDER BY date, time
+    """, user_id, start, end))
+
+
+async def get_tasks_for_user_today(user_id: int):
+    today = date.today()
+    return await get_tasks_in_range(user_id, today, today)
 
 
 async def mark_task_done(task_id: int):
@@ -111,6 +436,7 @@ async def mark_task_done(task_id: int):
                 INSERT INTO task_logs (user_id, task_id, action, timestamp)
                 VALUES ($1, $2, 'done', CURRENT_TIMESTAMP)
             """, user_id, task_id)
+            _mark_write(user_id)
 
 async def mark_task_missed(task_id: int):
     pool = await connect()
@@ -123,12 +449,15 @@ async def mark_task_missed(task_id: int):
                 INSERT INTO task_logs (user_id, task_id, action, timestamp)
                 VALUES ($1, $2, 'missed', CURRENT_TIMESTAMP)
             """, user_id, task_id)
+            _mark_write(user_id)
 
 async def postpone_task(task_id: int, minutes: int):
     new_time = (datetime.now() + timedelta(minutes=minutes)).strftime("%H:%M")
     pool = await connect()
     async with pool.acquire() as conn:
-        await conn.execute("UPDATE tasks SET time = $1 WHERE id = $2", new_time, task_id)
+        user_id = await conn.fetchval("UPDATE tasks SET time = $1 WHERE id = $2 RETURNING user_id", new_time, task_id)
+    if user_id is not None:
+        _mark_write(user_id)
     return new_time
 
 async def log_task_action(user_id: int, task_id: int, action: str):
@@ -139,10 +468,10 @@ async def log_task_action(user_id: int, task_id: int, action: str):
             INSERT INTO task_logs (user_id, task_id, action, timestamp)
             VALUES ($1, $2, $3, $4)
         """, user_id, task_id, action, timestamp)
+    _mark_write(user_id)
 
 async def get_user_stats(user_id: int):
-    pool = await connect()
-    async with pool.acquire() as conn:
+    async def query(conn):
         done = await conn.fetchval("""
             SELECT COUNT(*) FROM task_logs WHERE user_id = $1 AND action = 'done'
         """, user_id)
@@ -155,6 +484,9 @@ async def get_user_stats(user_id: int):
             WHERE user_id = $1 AND action = 'done'
             ORDER BY DATE(timestamp)
         """, user_id)
+        return done, missed, rows
+
+    done, missed, rows = await _read(user_id, query)
 
     days = [datetime.strptime(str(row['date']), "%Y-%m-%d").date() for row in rows]
     streak = 0
@@ -176,6 +508,7 @@ async def create_project(user_id: int, title: str):
     pool = await connect()
     async with pool.acquire() as conn:
         await conn.execute("INSERT INTO projects (user_id, title) VALUES ($1, $2)", user_id, title)
+    _mark_write(user_id)
 
 async def get_project_id(user_id: int, title: str):
     pool = await connect()
@@ -190,6 +523,9 @@ async def complete_project(project_id: int):
             UPDATE tasks SET completed = 1, completed_at = CURRENT_TIMESTAMP
             WHERE project_id = $1
         """, project_id)
+        user_id = await conn.fetchval("SELECT user_id FROM projects WHERE id = $1", project_id)
+    if user_id is not None:
+        _mark_write(user_id)
 
 async def get_user_projects(user_id: int):
     pool = await connect()
@@ -207,36 +543,34 @@ async def get_tasks_for_project(project_id: int):
         """, project_id)
 
 async def get_user_projects_with_progress(user_id: int):
-    pool = await connect()
-    async with pool.acquire() as conn:
-        return await conn.fetch("""
-            SELECT p.id, p.title,
-                   COUNT(t.id) AS total,
-                   SUM(CASE WHEN t.completed = 1 THEN 1 ELSE 0 END) AS completed
-            FROM projects p
-            LEFT JOIN tasks t ON t.project_id = p.id
-            WHERE p.user_id = $1
-            GROUP BY p.id
-        """, user_id)
+    return await _read(user_id, lambda conn: conn.fetch("""
+        SELECT p.id, p.title,
+               COUNT(t.id) AS total,
+               SUM(CASE WHEN t.completed = 1 THEN 1 ELSE 0 END) AS completed
+        FROM projects p
+        LEFT JOIN tasks t ON t.project_id = p.id
+        WHERE p.user_id = $1
+        GROUP BY p.id
+    """, user_id))
 
 async def delete_project(project_id: int):
     pool = await connect()
     async with pool.acquire() as conn:
         await conn.execute("DELETE FROM tasks WHERE project_id = $1", project_id)
-        await conn.execute("DELETE FROM projects WHERE id = $1", project_id)
+        user_id = await conn.fetchval("DELETE FROM projects WHERE id = $1 RETURNING user_id", project_id)
+    if user_id is not None:
+        _mark_write(user_id)
 
 async def get_completed_tasks_last_week(user_id: int):
     one_week_ago = (datetime.now() - timedelta(days=7)).date()
-    pool = await connect()
-    async with pool.acquire() as conn:
-        return await conn.fetch("""
-            SELECT tasks.title, task_logs.timestamp
-            FROM task_logs
-            JOIN tasks ON task_logs.task_id = tasks.id
-            WHERE task_logs.user_id = $1 AND task_logs.action = 'done'
-            AND DATE(task_logs.timestamp) >= $2
-            ORDER BY task_logs.timestamp DESC
-        """, user_id, one_week_ago)
+    return await _read(user_id, lambda conn: conn.fetch("""
+        SELECT tasks.title, task_logs.timestamp
+        FROM task_logs
+        JOIN tasks ON task_logs.task_id = tasks.id
+        WHERE task_logs.user_id = $1 AND task_logs.action = 'done'
+        AND DATE(task_logs.timestamp) >= $2
+        ORDER BY task_logs.timestamp DESC
+    """, user_id, one_week_ago))
 
 async def get_all_user_ids():
     pool = await connect()
@@ -245,12 +579,71 @@ async def get_all_user_ids():
         return [row['user_id'] for row in rows]
 
 async def get_completed_tasks(user_id: int):
+    return await _read(user_id, lambda conn: conn.fetch("""
+        SELECT tasks.title, task_logs.timestamp
+        FROM task_logs
+        JOIN tasks ON task_logs.task_id = tasks.id
+        WHERE task_logs.user_id = $1 AND task_logs.action = 'done'
+        ORDER BY task_logs.timestamp DESC
+    """, user_id))
+
+def _build_search_query(text: str):
+    # "купить мол" -> "купить:* & мол:*" — ищем и по началу слов
+    words = re.findall(r"\w+", text.lower())
+    return " & ".join(f"{w}:*" for w in words) if words else None
+
+async def search_tasks(user_id: int, text: str, limit: int = 10, offset: int = 0):
+    query = _build_search_query(text)
+    if not query:
+        return []
+    return await _read(user_id, lambda conn: conn.fetch("""
+        WITH q AS (SELECT to_tsquery('russian', $2) AS query)
+        SELECT kind, title, date, time, completed, rank FROM (
+            SELECT 'task' AS kind, t.title, t.date, t.time, t.completed,
+                   ts_rank(t.title_tsv, q.query) AS rank
+            FROM tasks t, q
+            WHERE t.user_id = $1 AND t.title_tsv @@ q.query
+            UNION ALL
+            SELECT 'project' AS kind, p.title, NULL, NULL, NULL,
+                   ts_rank(p.title_tsv, q.query) AS rank
+            FROM projects p, q
+            WHERE p.user_id = $1 AND p.title_tsv @@ q.query
+        ) found
+        ORDER BY rank DESC, date DESC NULLS FIRST, time
+        LIMIT $3 OFFSET $4
+    """, user_id, query, limit, offset))
+
+ANALYTICS_VIEWS = ("daily_activity", "user_project_stats")
+
+async def refresh_analytics():
+    # CONCURRENTLY не блокирует чтение ни вьюх, ни исходных таблиц
     pool = await connect()
     async with pool.acquire() as conn:
-        return await conn.fetch("""
-            SELECT tasks.title, task_logs.timestamp
-            FROM task_logs
-            JOIN tasks ON task_logs.task_id = tasks.id
-            WHERE task_logs.user_id = $1 AND task_logs.action = 'done'
-            ORDER BY task_logs.timestamp DESC
-        """, user_id)
+        for view in ANALYTICS_VIEWS:
+            await conn.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view}")
+            await conn.execute("""
+                INSERT INTO stats_refreshes (view_name, refreshed_at)
+                VALUES ($1, CURRENT_TIMESTAMP)
+                ON CONFLICT (view_name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at
+            """, view)
+
+async def get_admin_stats(days: int = 7):
+    since = date.today() - timedelta(days=days - 1)
+    pool = await connect()
+    async with pool.acquire() as conn:
+        daily = await conn.fetch("""
+            SELECT day, active_users, tasks_created, done, missed
+            FROM daily_activity
+            WHERE day >= $1
+            ORDER BY day DESC
+        """, since)
+        projects = await conn.fetchrow("""
+            SELECT COUNT(*) AS users, COALESCE(SUM(projects), 0) AS projects, COALESCE(MAX(projects), 0) AS max_projects
+            FROM user_project_stats
+        """)
+        refreshes = await conn.fetch("SELECT view_name, refreshed_at FROM stats_refreshes")
+    return {
+        "daily": daily,
+        "projects": projects,
+        "refreshed": {row["view_name"]: row["refreshed_at"] for row in refreshes},
+    }
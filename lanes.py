@@ -0,0 +1,98 @@
+import asyncio
+import os
+from aiogram import BaseMiddleware
+
+# 🛣 Апдейты одного пользователя обрабатываются строго по очереди,
+# апдейты разных пользователей — параллельно на нескольких дорожках
+UPDATE_LANES = int(os.getenv("UPDATE_LANES", "16"))
+# Сами очереди не ограничены: блокирующий put() мог бы пропустить вперёд более
+# поздний апдейт того же пользователя. Общее число апдейтов в работе ограничивает
+# polling (см. max_in_flight), а эта глубина на дорожке считается «перегрузом»
+UPDATE_LANE_SIZE = int(os.getenv("UPDATE_LANE_SIZE", "100"))
+
+
+class UserLanes(BaseMiddleware):
+    def __init__(self, lanes: int = UPDATE_LANES, lane_size: int = UPDATE_LANE_SIZE):
+        self.lanes = lanes
+        self.lane_size = lane_size
+        self._queues = []
+        self._workers = []
+        self._busy = []
+        self._pending = 0
+        self._processed = 0
+
+    @property
+    def max_in_flight(self):
+        # Лимит для tasks_concurrency_limit у dp.start_polling
+        return self.lanes * self.lane_size
+
+    def _start(self):
+        # Очереди создаём лениво, уже внутри работающего event loop
+        self._queues = [asyncio.Queue() for _ in range(self.lanes)]
+        self._busy = [False] * self.lanes
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.lanes)]
+
+    async def _worker(self, lane: int):
+        queue = self._queues[lane]
+        while True:
+            handler, event, data, future = await queue.get()
+            self._busy[lane] = True
+            try:
+                result = await handler(event, data)
+                if not future.done():
+                    future.set_result(result)
+            except BaseException as e:
+                if not future.done():
+                    if isinstance(e, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(e)
+                # Дорожка останавливается, только если отменили сам воркер
+                if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                    raise
+            finally:
+                self._busy[lane] = False
+                self._pending -= 1
+                self._processed += 1
+                queue.task_done()
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        if not self._workers:
+            self._start()
+
+        future = asyncio.get_running_loop().create_future()
+        # put_nowait без await: апдейты встают в очередь ровно в порядке поступления
+        self._queues[user.id % self.lanes].put_nowait((handler, event, data, future))
+        self._pending += 1
+        return await future
+
+    def stats(self):
+        depths = [queue.qsize() for queue in self._queues]
+        return {
+            "lanes": self.lanes,
+            "lane_size": self.lane_size,
+            "busy": sum(self._busy),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "saturated": sum(1 for depth in depths if depth >= self.lane_size),
+            "processed": self._processed,
+        }
+
+    async def close(self, timeout: float):
+        # Даём дорожкам доработать очередь, затем останавливаем воркеры
+        if not self._workers:
+            return
+        if self._pending and timeout > 0:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self._pending:
+            print(f"⚠️ Не успели обработать до остановки апдейтов: {self._pending}")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
@@ -0,0 +1,70 @@
+import asyncio
+import types
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+from lanes import UserLanes
+
+
+def user_data(user_id):
+    return {"event_from_user": types.SimpleNamespace(id=user_id)}
+
+
+async def run_interleaved(lanes, handler, events):
+    tasks = [asyncio.create_task(lanes(handler, event, user_data(user_id))) for user_id, event in events]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    await lanes.close(1)
+    return results
+
+
+def test_each_user_keeps_order_across_interleaved_updates():
+    seen = {}
+
+    async def handler(event, data):
+        user_id, n = event
+        # Первые апдейты «медленнее», чтобы без дорожек порядок бы перемешался
+        await asyncio.sleep(0.001 * (n % 3 == 0))
+        seen.setdefault(user_id, []).append(n)
+        return n
+
+    events = [(n % 7, (n % 7, n)) for n in range(200)]
+    results = asyncio.run(run_interleaved(UserLanes(lanes=3, lane_size=1), handler, events))
+
+    assert results == list(range(200))
+    for user_id, order in seen.items():
+        assert order == sorted(order)
+
+
+def test_failing_handlers_do_not_stop_the_lane():
+    class Boom(Exception):
+        pass
+
+    async def handler(event, data):
+        await asyncio.sleep(0)
+        if event == "error":
+            raise Boom()
+        if event == "cancel":
+            raise asyncio.CancelledError()
+        return event
+
+    events = [(1, 0), (1, "error"), (1, "cancel"), (1, 1), (1, 2)]
+    results = asyncio.run(run_interleaved(UserLanes(lanes=1, lane_size=1), handler, events))
+
+    assert results[0] == 0
+    assert isinstance(results[1], Boom)
+    assert isinstance(results[2], asyncio.CancelledError)
+    assert results[3:] == [1, 2]
+
+
+def test_updates_without_user_bypass_lanes():
+    async def handler(event, data):
+        return event
+
+    async def run():
+        lanes = UserLanes(lanes=1, lane_size=1)
+        result = await lanes(handler, "ping", {})
+        return result, lanes.stats()["processed"]
+
+    assert asyncio.run(run()) == ("ping", 0)